@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+"""Extracción de datos de facturas escaneadas mediante OCR.
+
+Procesa un lote de imágenes de facturas, reconoce la tabla de detalles
+(cantidad, descripción, precio unitario, importe) y el total, y verifica
+la coherencia entre el total impreso y la suma de los importes.
+"""
+
+import atexit
+import collections
+import functools
+import glob
+import hashlib
+import math
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+from tesserocr import OEM, PSM, RIL, PyTessBaseAPI
+
+try:
+    from numba import njit, prange
+    _HAY_NUMBA = True
+except ImportError:
+    _HAY_NUMBA = False
+    prange = range
+
+try:
+    # RE2 compila la alternación en un DFA de coste lineal garantizado,
+    # sin retroceso; su interfaz es compatible con re.
+    import re2 as _re_escaner
+except ImportError:
+    _re_escaner = re
+
+RUTA_IMAGENES = 'facturas'
+RUTA_REPORTES = 'reportes'
+
+# Alias habituales con los que aparecen las cabeceras de columna
+# en facturas en español.
+MAPEO_COLUMNAS = {
+    'Cantidad': ['cant', 'cantidad', 'qty'],
+    'Descripcion': ['descripción', 'descripcion', 'producto', 'servicio', 'concepto'],
+    'P.Unit': ['p.unit', 'unitario', 'precio', 'p/u'],
+    'Importe': ['importe', 'subtotal', 'valor'],
+}
+
+# Búsqueda de alias precompilada: un solo escaneo por texto en lugar de
+# una búsqueda de subcadena por cada alias.
+ALIAS_A_COLUMNA = {alias: nombre
+                   for nombre, alias_list in MAPEO_COLUMNAS.items()
+                   for alias in alias_list}
+_ALT_ALIAS = '|'.join(map(re.escape, sorted(ALIAS_A_COLUMNA,
+                                            key=len, reverse=True)))
+ALIAS_RE = re.compile(r'\b(?:' + _ALT_ALIAS + r')\b')
+
+# Escáner único por línea: clasifica en una sola pasada si la línea
+# contiene cabeceras de columna y/o la palabra clave del total.
+ESCANER_LINEA = _re_escaner.compile(
+    r'\b(?:(?P<col>' + _ALT_ALIAS + r')|(?P<total>total))\b')
+
+
+def _sauvola_nucleo(gris, I, I2, w, k, R):
+    """Núcleo de Sauvola fusionado: media, desviación y umbral por píxel.
+
+    Con numba se compila en un bucle paralelo sin materializar los
+    arrays intermedios de media/desviación/umbral de la versión NumPy.
+    """
+    alto, ancho = gris.shape
+    area = float(w * w)
+    salida = np.empty((alto, ancho), dtype=np.uint8)
+    for y in prange(alto):
+        for x in range(ancho):
+            suma = I[y + w, x + w] - I[y, x + w] - I[y + w, x] + I[y, x]
+            suma2 = I2[y + w, x + w] - I2[y, x + w] - I2[y + w, x] + I2[y, x]
+            media = suma / area
+            var = suma2 / area - media * media
+            if var < 0.0:
+                var = 0.0
+            umbral = media * (1.0 + k * (math.sqrt(var) / R - 1.0))
+            salida[y, x] = 255 if gris[y, x] > umbral else 0
+    return salida
+
+
+if _HAY_NUMBA:
+    _sauvola_nucleo = njit(parallel=True, cache=True,
+                           fastmath=True)(_sauvola_nucleo)
+
+
+def _binarizar_sauvola(gris, w=25, k=0.34, R=128.0):
+    """Binariza con el umbral local de Sauvola sobre imágenes integrales.
+
+    La media y desviación de cada ventana de w×w se obtienen con cuatro
+    lecturas de las imágenes integrales, en coste O(1) por píxel. Sin
+    numba se recurre al umbral de media local de OpenCV, que usa el
+    mismo camino de imagen integral internamente y evita materializar
+    los arrays intermedios de una versión NumPy.
+    """
+    if not _HAY_NUMBA:
+        return cv2.adaptiveThreshold(gris, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                     cv2.THRESH_BINARY, w, 10)
+
+    mitad = w // 2
+    borde = cv2.copyMakeBorder(gris, mitad, w - 1 - mitad, mitad, w - 1 - mitad,
+                               cv2.BORDER_REFLECT)
+    flotante = borde.astype(np.float64)
+    I = cv2.integral(flotante)
+    I2 = cv2.integral(np.square(flotante))
+    return _sauvola_nucleo(gris, I, I2, w, k, R)
+
+
+# Los escaneos por encima de ~300 ppp no mejoran el LSTM de Tesseract y
+# su coste crece con el número de píxeles: por encima de este ancho/alto
+# la imagen se reduce a _DIMENSION_OBJETIVO antes de binarizar.
+_DIMENSION_MAXIMA = 2500
+_DIMENSION_OBJETIVO = 2000
+
+
+def preprocesar_imagen(ruta_imagen):
+    """Carga la imagen y la binariza para mejorar el reconocimiento.
+
+    El resultado se cachea en un .npy identificado por mtime y tamaño
+    del original, de modo que repetir el lote (ajustes del reporte,
+    desarrollo) se salta la decodificación y el binarizado.
+    """
+    # El nombre del archivo se identifica por un hash de longitud fija
+    # del basename completo: así 'a.png' y 'a.jpg' no comparten entrada
+    # y la limpieza de un archivo nunca puede borrar la de otro cuyo
+    # nombre empiece igual.
+    base = hashlib.sha1(
+        os.path.basename(ruta_imagen).encode('utf-8')).hexdigest()[:16]
+    clave = f'{os.path.getmtime(ruta_imagen)}_{os.path.getsize(ruta_imagen)}'
+    dir_cache = os.path.join(RUTA_REPORTES, '.cache')
+    ruta_cache = os.path.join(dir_cache, f'{base}_{clave}.npy')
+    if os.path.exists(ruta_cache):
+        return np.load(ruta_cache)
+
+    # Decodificar directamente a un solo canal: evita el buffer BGR de
+    # 3 canales y la pasada de cvtColor que lo tiraba a continuación.
+    gris = cv2.imread(ruta_imagen, cv2.IMREAD_GRAYSCALE)
+    alto, ancho = gris.shape
+    if max(alto, ancho) > _DIMENSION_MAXIMA:
+        escala = _DIMENSION_OBJETIVO / max(alto, ancho)
+        gris = cv2.resize(gris, (int(ancho * escala), int(alto * escala)),
+                          interpolation=cv2.INTER_AREA)
+    # Sauvola segmenta mejor que un umbral de media local cuando hay
+    # iluminación irregular o tinta traspasada: menos palabras acaban
+    # por debajo del corte de confianza del OCR.
+    binaria = _binarizar_sauvola(gris)
+
+    os.makedirs(dir_cache, exist_ok=True)
+    # Retirar entradas de versiones anteriores del mismo archivo.
+    for viejo in glob.glob(os.path.join(dir_cache, f'{base}_*.npy')):
+        if viejo != ruta_cache:
+            try:
+                os.remove(viejo)
+            except OSError:
+                pass
+    np.save(ruta_cache, binaria)
+    return binaria
+
+
+_RE_HAS_DIGIT = re.compile(r'\d')
+
+
+@functools.lru_cache(maxsize=4096)
+def normalizar_monto(monto_str):
+    """Convierte un texto de monto ('1.234,56', '1,234.56') a céntimos.
+
+    Devuelve el monto como entero de céntimos, o None si el texto no
+    representa un monto válido. Se llama una vez por palabra en varias
+    pasadas, así que descarta rápido lo que no contiene dígitos y
+    cachea los tokens repetidos entre facturas. Los montos tienen como
+    mucho dos decimales, y como enteros las sumas y comparaciones
+    posteriores son operaciones nativas; solo el reporte los formatea.
+    """
+    if not _RE_HAS_DIGIT.search(monto_str):
+        return None
+    limpio = monto_str.strip().replace('$', '')
+    negativo = limpio.startswith('-')
+    if negativo:
+        limpio = limpio[1:]
+    # El último separador (punto o coma) se interpreta como decimal;
+    # los anteriores, como separadores de miles.
+    ultimo_sep = max(limpio.rfind('.'), limpio.rfind(','))
+    try:
+        if ultimo_sep == -1:
+            centimos = int(limpio) * 100
+        else:
+            entero = limpio[:ultimo_sep].replace('.', '').replace(',', '')
+            fraccion = limpio[ultimo_sep + 1:].ljust(2, '0')[:2]
+            centimos = int(entero or '0') * 100 + int(fraccion)
+    except ValueError:
+        return None
+    return -centimos if negativo else centimos
+
+
+def _formatear_centimos(centimos):
+    """Formatea céntimos como texto con dos decimales para el reporte."""
+    return '?' if centimos is None else f'{centimos / 100:.2f}'
+
+
+# APIs de tesserocr por hilo para el OCR de franjas en paralelo:
+# Tesseract no escala internamente más allá de ~2 hilos por imagen,
+# pero varias instancias sobre franjas distintas sí lo hacen.
+_local_hilo = threading.local()
+_apis_franjas = []
+
+# Una factura más alta que esto se trocea en franjas por bandas en
+# blanco y se reconoce en paralelo. Debe quedar por debajo de
+# _DIMENSION_OBJETIVO: el preprocesado reduce las imágenes grandes a esa
+# dimensión máxima, y un umbral mayor dejaría el troceo inalcanzable.
+_ALTO_MINIMO_TROCEO = 1600
+_N_FRANJAS = 4
+
+# Pool de hilos para las franjas, compartido por todas las facturas del
+# proceso: si se creara uno por factura, sus hilos (y las APIs por hilo
+# de _api_de_hilo) morirían tras cada imagen y el modelo se recargaría
+# por franja, el sobrecoste que la API persistente existe para evitar.
+_pool_franjas = None
+_candado_pool_franjas = threading.Lock()
+
+
+def _api_de_hilo():
+    """Devuelve la API de tesserocr del hilo actual, creándola una vez."""
+    api = getattr(_local_hilo, 'api', None)
+    if api is None:
+        api = PyTessBaseAPI(path=os.environ['TESSDATA_PREFIX'], lang='spa',
+                            oem=OEM.LSTM_ONLY, psm=PSM.SINGLE_COLUMN)
+        _local_hilo.api = api
+        _apis_franjas.append(api)
+    return api
+
+
+def _cerrar_pool_franjas():
+    global _pool_franjas
+    if _pool_franjas is not None:
+        _pool_franjas.shutdown(wait=True)
+        _pool_franjas = None
+    while _apis_franjas:
+        _apis_franjas.pop().End()
+
+
+def _pool_de_franjas():
+    """Devuelve el pool de hilos de franjas, creándolo una sola vez."""
+    global _pool_franjas
+    with _candado_pool_franjas:
+        if _pool_franjas is None:
+            _pool_franjas = ThreadPoolExecutor(max_workers=_N_FRANJAS)
+            atexit.register(_cerrar_pool_franjas)
+    return _pool_franjas
+
+
+def _cortes_en_blanco(binaria, n):
+    """Elige hasta n-1 filas de corte dentro de bandas sin tinta."""
+    tinta_fila = (binaria < 128).sum(axis=1)
+    filas_blancas = np.flatnonzero(tinta_fila == 0)
+    if filas_blancas.size == 0:
+        return []
+    alto = binaria.shape[0]
+    cortes = []
+    for objetivo in np.linspace(0, alto, n + 1)[1:-1]:
+        corte = int(filas_blancas[np.argmin(np.abs(filas_blancas - objetivo))])
+        # Descartar cortes que dejarían franjas demasiado pequeñas.
+        if (not cortes or corte - cortes[-1] > 200) and alto - corte > 200:
+            cortes.append(corte)
+    return cortes
+
+
+# Las palabras se guardan como estructura de arrays paralelos (un array
+# por campo) en vez de una lista de dicts: menos memoria por palabra y
+# los ordenamientos/filtros posteriores quedan en NumPy nativo.
+_CAMPOS_PALABRAS = ('text', 'left', 'top', 'width', 'height', 'line')
+
+
+def _palabras_vacias():
+    return {'text': np.empty(0, dtype=object),
+            'left': np.empty(0, dtype=np.int32),
+            'top': np.empty(0, dtype=np.int32),
+            'width': np.empty(0, dtype=np.int32),
+            'height': np.empty(0, dtype=np.int32),
+            'line': np.empty(0, dtype=np.int32)}
+
+
+def _ocr_palabras(api, imagen):
+    """Reconoce una imagen y devuelve las palabras fiables con posición.
+
+    Cada palabra lleva el número de línea que asigna el segmentador de
+    Tesseract, de modo que no hace falta reconstruir las líneas en
+    Python a partir de las coordenadas.
+    """
+    api.SetImage(Image.fromarray(imagen))
+    api.Recognize()
+    textos, confs, cajas, num_lineas = [], [], [], []
+    it = api.GetIterator()
+    if it is not None:
+        num_linea = -1
+        while True:
+            if it.IsAtBeginningOf(RIL.TEXTLINE):
+                num_linea += 1
+            textos.append((it.GetUTF8Text(RIL.WORD) or '').strip())
+            confs.append(it.Confidence(RIL.WORD))
+            cajas.append(it.BoundingBox(RIL.WORD) or (0, 0, 0, 0))
+            num_lineas.append(num_linea)
+            if not it.Next(RIL.WORD):
+                break
+    if not textos:
+        return _palabras_vacias()
+    # Filtrar por confianza con una máscara vectorizada en vez de una
+    # comparación interpretada por palabra.
+    conf = np.asarray(confs, dtype=np.float32)
+    no_vacia = np.array([t != '' for t in textos])
+    indices = np.flatnonzero((conf > 60) & no_vacia)
+    cajas_arr = np.asarray(cajas, dtype=np.int32)[indices]
+    return {
+        'text': np.asarray(textos, dtype=object)[indices],
+        'left': cajas_arr[:, 0],
+        'top': cajas_arr[:, 1],
+        'width': cajas_arr[:, 2] - cajas_arr[:, 0],
+        'height': cajas_arr[:, 3] - cajas_arr[:, 1],
+        'line': np.asarray(num_lineas, dtype=np.int32)[indices],
+    }
+
+
+def reconocer_factura(imagen_preprocesada, api):
+    """Reconoce el texto de una factura y extrae detalles y total.
+
+    Recibe la API de tesserocr ya inicializada para no recargar el
+    modelo en cada factura. Devuelve (detalles, total_factura,
+    total_calculado).
+    """
+    # El troceo en franjas solo compensa fuera del pool de procesos del
+    # lote (factura suelta, llamadas directas): ahí reparte una imagen
+    # alta entre núcleos ociosos. Dentro del lote los núcleos ya están
+    # saturados con un proceso cada uno.
+    cortes = []
+    alto = imagen_preprocesada.shape[0]
+    if not _en_trabajador_lote and alto >= _ALTO_MINIMO_TROCEO:
+        cortes = _cortes_en_blanco(imagen_preprocesada, _N_FRANJAS)
+
+    if cortes:
+        # Facturas altas: reconocer cada franja en un hilo con su propia
+        # API (Recognize suelta el GIL) y reubicar las palabras sumando
+        # el desplazamiento vertical de su franja.
+        limites = [0] + cortes + [alto]
+        franjas = list(zip(limites[:-1], limites[1:]))
+
+        def _ocr_franja(franja):
+            y0, y1 = franja
+            resultado = _ocr_palabras(_api_de_hilo(),
+                                      imagen_preprocesada[y0:y1])
+            resultado['top'] += y0
+            return resultado
+
+        parciales = list(_pool_de_franjas().map(_ocr_franja, franjas))
+        # Renumerar las líneas de cada franja a continuación de las de
+        # la franja anterior antes de concatenar.
+        desplazamiento = 0
+        for parcial in parciales:
+            if parcial['line'].size:
+                parcial['line'] += desplazamiento
+                desplazamiento = int(parcial['line'][-1]) + 1
+        palabras = {campo: np.concatenate([p[campo] for p in parciales])
+                    for campo in _CAMPOS_PALABRAS}
+    else:
+        palabras = _ocr_palabras(api, imagen_preprocesada)
+
+    # Agrupar por el número de línea que ya asignó el segmentador de
+    # Tesseract, ordenando dentro de cada línea por la coordenada
+    # horizontal. Cada línea queda como un array de índices sobre los
+    # arrays de palabras.
+    lineas = []
+    if palabras['text'].size:
+        orden = np.lexsort((palabras['left'], palabras['line']))
+        lineas_ordenadas = palabras['line'][orden]
+        cortes = np.flatnonzero(np.diff(lineas_ordenadas) > 0) + 1
+        lineas = np.split(orden, cortes)
+
+    detalles = []
+    total_factura = None
+    columnas = {}
+    estado = 'buscando_columnas'
+
+    for linea in lineas:
+        textos_linea = palabras['text'][linea]
+        linea_texto = ' '.join(textos_linea).lower()
+        # Una sola pasada del escáner decide qué contiene la línea.
+        etiquetas = {m.lastgroup for m in ESCANER_LINEA.finditer(linea_texto)}
+
+        if estado == 'buscando_columnas':
+            if 'col' in etiquetas:
+                for i in linea:
+                    coincidencia = ALIAS_RE.search(palabras['text'][i].lower())
+                    if coincidencia:
+                        columnas[ALIAS_A_COLUMNA[coincidencia.group(0)]] = \
+                            int(palabras['left'][i])
+                if len(columnas) >= 2:
+                    estado = 'extrayendo_detalles'
+                    nombres_col = list(columnas)
+                    pos_col = np.array(list(columnas.values()))
+            continue
+
+        if 'total' in etiquetas:
+            montos_en_linea = [m for m in map(normalizar_monto, textos_linea)
+                               if m is not None]
+            if montos_en_linea:
+                total_factura = montos_en_linea[-1]
+                estado = 'buscando_total'
+                # Con detalles y total ya extraídos, el resto de la
+                # factura (pie legal, firmas) no aporta nada.
+                if detalles:
+                    break
+            continue
+
+        if estado == 'extrayendo_detalles':
+            # Saltar restos de cabecera que se repiten en cada página.
+            if 'col' in etiquetas:
+                continue
+
+            # Asignar cada palabra a la columna más cercana, con una sola
+            # operación de broadcast en lugar de un dict de distancias
+            # por palabra.
+            detalle_linea = {nombre_col: [] for nombre_col in columnas}
+            lefts = palabras['left'][linea]
+            asignacion = np.argmin(np.abs(lefts[:, None] - pos_col[None, :]),
+                                   axis=1)
+            for texto, col in zip(textos_linea, asignacion):
+                detalle_linea[nombres_col[col]].append(texto)
+
+            importe = normalizar_monto(' '.join(detalle_linea.get('Importe', [])))
+            if importe is None:
+                continue
+            detalles.append({
+                'Cantidad': ' '.join(detalle_linea.get('Cantidad', [])),
+                'Descripcion': ' '.join(detalle_linea.get('Descripcion', [])),
+                'P.Unit': normalizar_monto(' '.join(detalle_linea.get('P.Unit', []))),
+                'Importe': importe,
+            })
+
+    total_calculado = sum(d['Importe'] for d in detalles)
+    return detalles, total_factura, total_calculado
+
+
+# API de tesserocr de cada proceso trabajador, creada una sola vez por
+# trabajador en _inicializar_trabajador. El indicador desactiva el
+# troceo en franjas dentro del lote: con un proceso por núcleo ya no hay
+# núcleos libres para los hilos de franja, y sumarlos solo multiplicaría
+# las instancias de Tesseract compitiendo entre sí.
+_api_trabajador = None
+_en_trabajador_lote = False
+
+
+def _inicializar_trabajador():
+    """Abre la API de tesserocr una vez por proceso trabajador."""
+    global _api_trabajador, _en_trabajador_lote
+    _api_trabajador = PyTessBaseAPI(path=os.environ['TESSDATA_PREFIX'],
+                                    lang='spa', oem=OEM.LSTM_ONLY,
+                                    psm=PSM.SINGLE_COLUMN)
+    _en_trabajador_lote = True
+
+
+def procesar_una(nombre_archivo, imagen):
+    """Reconoce una factura ya preprocesada en el proceso trabajador."""
+    detalles, total, calculado = reconocer_factura(imagen, _api_trabajador)
+    return {
+        'archivo': nombre_archivo,
+        'detalles': detalles,
+        'total_factura': total,
+        'total_calculado': calculado,
+        'coherente': total is not None and total == calculado,
+    }
+
+
+def procesar_lote_facturas():
+    """Procesa todas las facturas de RUTA_IMAGENES y genera un reporte."""
+    # scandir devuelve entradas con la ruta completa ya compuesta y el
+    # tipo cacheado del directorio, sin un stat ni un join por archivo.
+    with os.scandir(RUTA_IMAGENES) as entradas:
+        archivos_imagen = [
+            (e.name, e.path) for e in entradas if e.is_file()
+            and e.name.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff'))]
+
+    # Segmentar el lote en dos etapas encadenadas: un hilo productor
+    # hace el preprocesado (decodificación + binarizado, que sueltan el
+    # GIL) mientras los procesos trabajadores hacen el OCR, que es lo
+    # intensivo en CPU. La cola acotada evita acumular imágenes en
+    # memoria si el OCR va más lento.
+    cola = queue.Queue(maxsize=4)
+
+    def _productor():
+        # Un fallo al preprocesar (imagen corrupta, archivo ilegible)
+        # se encola para relanzarlo en el hilo principal; si no, el
+        # consumidor quedaría bloqueado esperando un sentinel que nunca
+        # llega.
+        try:
+            for nombre_archivo, ruta_completa in archivos_imagen:
+                cola.put((nombre_archivo, preprocesar_imagen(ruta_completa)))
+        except Exception as exc:
+            cola.put(exc)
+        else:
+            cola.put(None)
+
+    threading.Thread(target=_productor, daemon=True).start()
+
+    # Tesseract limitado a un hilo por proceso para que los trabajadores
+    # no compitan entre sí por los núcleos.
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    max_pendientes = (os.cpu_count() or 1) * 2
+    pendientes = collections.deque()
+    resultados = []
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             initializer=_inicializar_trabajador) as ex:
+        while (item := cola.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            if len(pendientes) >= max_pendientes:
+                resultados.append(pendientes.popleft().result())
+            pendientes.append(ex.submit(procesar_una, *item))
+        while pendientes:
+            resultados.append(pendientes.popleft().result())
+
+    os.makedirs(RUTA_REPORTES, exist_ok=True)
+    ruta_reporte = os.path.join(RUTA_REPORTES, 'reporte_lote.txt')
+    # Componer el reporte en memoria y volcarlo de una sola escritura.
+    bloques = []
+    for resultado in resultados:
+        bloques.append('=' * 60 + '\n')
+        bloques.append(f"Factura: {resultado['archivo']}\n")
+        for d in resultado['detalles']:
+            bloques.append(f"  {d['Cantidad']:>6} {d['Descripcion']:<30}"
+                           f" {_formatear_centimos(d['P.Unit'])}"
+                           f" {_formatear_centimos(d['Importe'])}\n")
+        bloques.append(
+            f"Total impreso:   {_formatear_centimos(resultado['total_factura'])}\n"
+            f"Total calculado: {_formatear_centimos(resultado['total_calculado'])}\n"
+            f"Coherente: {'sí' if resultado['coherente'] else 'NO'}\n")
+    with open(ruta_reporte, 'w', encoding='utf-8', buffering=1 << 16) as f:
+        f.write(''.join(bloques))
+
+    return resultados
+
+
+if __name__ == '__main__':
+    procesar_lote_facturas()